@@ -4,10 +4,8 @@ import pandas as pd
 from scipy.signal import hilbert
 from obspy.signal.util import _npts2nfft
 from obspy.signal.invsim import cosine_taper
-from obspy.signal.regression import linear_regression
 from obspy.core.util.base import _get_function_from_entry_point
 from obspy.core.inventory import Inventory, Network, Station, Channel, Site
-from scipy.fftpack import fft,ifft,next_fast_len
 from obspy.signal.filter import bandpass,lowpass
 import matplotlib.pyplot as plt
 """
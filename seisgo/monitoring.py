@@ -1,15 +1,17 @@
-import obspy,scipy,time,pycwt,pickle,os
+import obspy,scipy,time,pycwt,pickle,os,math
 import numpy as np
 from obspy.signal.invsim import cosine_taper
-from scipy.fftpack import fft,ifft,next_fast_len
+from scipy.fft import fft,ifft,rfft,irfft,fftfreq,next_fast_len
 from obspy.signal.filter import bandpass
 from obspy import UTCDateTime
 from seisgo.types import DvvData
 from seisgo import utils,helpers
 import matplotlib.pyplot as plt
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import pyasdf
-from scipy.signal import correlate,correlation_lags
+from pycwt.wavelet import _check_parameter_wavelet
+from scipy.signal import correlation_lags
 from scipy.stats import linregress
 
 '''
@@ -94,8 +96,8 @@ def get_dvv(corrdata,freq,win,ref=None,stack_method='linear',offset=1.0,resoluti
     zero_indx = zero_indx0[np.argmin(np.abs(tvec_all[zero_indx0]))]
     tvec_half=tvec_all[zero_indx:]
     # casual and acasual coda window
-    pwin_indx = np.where((tvec_all>=np.min(twin))&(tvec_all<=np.max(twin)))[0]
-    nwin_indx = np.where((tvec_all<=-np.min(twin))&(tvec_all>=-np.max(twin)))[0]
+    pwin_indx = np.where((tvec_all>=min(twin))&(tvec_all<=max(twin)))[0]
+    nwin_indx = np.where((tvec_all<=-min(twin))&(tvec_all>=-max(twin)))[0]
     pcor_cc = np.zeros(shape=(nwin),dtype=np.float32)
     ncor_cc = np.zeros(shape=(nwin),dtype=np.float32)
     pcur=np.zeros(shape=(nwin,zero_indx+1),dtype=np.float32)
@@ -107,22 +109,18 @@ def get_dvv(corrdata,freq,win,ref=None,stack_method='linear',offset=1.0,resoluti
     # load all current waveforms and get corr-coeff
     if normalize:
         ref /= np.max(np.abs(ref))
-        # loop through each cur waveforms
-        for ii in range(nwin):
-            cur[ii] /= np.max(np.abs(cur[ii]))
+        cur /= np.max(np.abs(cur),axis=1,keepdims=True)
     #do whitening if specified.
     if whiten != 'no':
         ref = utils.whiten(ref,cdata.dt,freq[0],freq[1],method=whiten,smooth=whiten_smooth,pad=whiten_pad)
         cur = utils.whiten(cur,cdata.dt,freq[0],freq[1],method=whiten,smooth=whiten_smooth,pad=whiten_pad)
-    for ii in range(nwin):
-        # get cc coeffient
-        pcor_cc[ii] = np.corrcoef(ref[pwin_indx],cur[ii,pwin_indx])[0,1]
-        ncor_cc[ii] = np.corrcoef(ref[nwin_indx],cur[ii,nwin_indx])[0,1]
-
-        pcur[ii] = cur[ii,zero_indx:]
-        ncur[ii] = np.flip(cur[ii,:zero_indx+1])
-        pref[ii] = ref[zero_indx:]
-        nref[ii] = np.flip(ref[:zero_indx+1])
+    # get cc coeffient
+    pcor_cc[:] = _pearson(ref[pwin_indx],cur[:,pwin_indx])
+    ncor_cc[:] = _pearson(ref[nwin_indx],cur[:,nwin_indx])
+    pcur[:] = cur[:,zero_indx:]
+    ncur[:] = np.flip(cur[:,:zero_indx+1],axis=1)
+    pref[:] = ref[zero_indx:]
+    nref[:] = np.flip(ref[:zero_indx+1])
     #######################
     ##### MONITORING #####
     dvv_pos,dvv_neg,freqall,maxcc_p,maxcc_n,error_p,error_n=[],[],[],[],[],[],[]
@@ -196,8 +194,8 @@ def get_dvv(corrdata,freq,win,ref=None,stack_method='linear',offset=1.0,resoluti
     #for now, if errors are negative, assign np.nan to dvv data.
     dvv_neg=np.array(dvv_neg)
     dvv_pos=np.array(dvv_pos)
-    idx1=np.where((error_n<0))
-    idx2=np.where((error_p<0))
+    idx1=error_n<0
+    idx2=error_p<0
     error_n[idx1]=np.nan
     error_p[idx2]=np.nan
     maxcc_n[idx1]=np.nan
@@ -212,7 +210,7 @@ def get_dvv(corrdata,freq,win,ref=None,stack_method='linear',offset=1.0,resoluti
 
     ######plotting
     if plot:
-        disp_indx = np.where(np.abs(tvec_all)<=np.max(twin)+0.2*win)[0]
+        disp_indx = np.where(np.abs(tvec_all)<=max(twin)+0.2*win)[0]
         tvec_disp=tvec_all[disp_indx]
         # tick inc for plotting
         if nwin>100:
@@ -433,10 +431,10 @@ def ts_dvv(ref, cur, t,twin, freq, dvmax=0.05, ndv=100, filter=True):
 
     # load common variables from dictionary
     dt   = t[1]-t[0]
-    tmin = np.min(twin)
-    tmax = np.max(twin)
-    fmin = np.min(freq)
-    fmax = np.max(freq)
+    tmin = min(twin)
+    tmax = max(twin)
+    fmin = min(freq)
+    fmax = max(freq)
     itvec = np.arange(int((tmin-t.min())/dt)+1, int((tmax-t.min())/dt)+1)
     tvec = t[itvec]
 
@@ -444,7 +442,6 @@ def ts_dvv(ref, cur, t,twin, freq, dvmax=0.05, ndv=100, filter=True):
     dvmin = -np.abs(dvmax)
     dvmax = np.abs(dvmax)
     Eps = 1+(np.linspace(dvmin, dvmax, ndv))
-    cof = np.zeros(Eps.shape,dtype=np.float32)
 
     #apply filter if requested
     if filter: #this is important when the data was not filtered before calling ts_dvv().
@@ -454,31 +451,9 @@ def ts_dvv(ref, cur, t,twin, freq, dvmax=0.05, ndv=100, filter=True):
     curwin_temp=cur[itvec]
     refwin=refwin_temp/np.max(np.abs(refwin_temp))
     curwin=curwin_temp/np.max(np.abs(curwin_temp))
-    # Set of stretched/compressed current waveforms
-    # plt.figure()
-    # plt.plot(tvec,refwin,'r',label='ref')
-    # plt.plot(tvec,curwin,'b',label='cur')
-    # plt.legend()
-    # plt.grid()
-    # plt.show()
-
-    # plt.figure()
-    for ii in range(len(Eps)):
-        nt = tvec*Eps[ii]
-        s = np.interp(x=tvec, xp=nt, fp=curwin)
-        tcheckmin=np.max([nt[0],tvec[0]]) #trim the zero paddings due to extrapolation.
-        tcheckmax=np.min([nt[-1],tvec[-1]])
-        tcheckidx=np.where((tvec>= tcheckmin) & (tvec<=tcheckmax))[0]
-        waveform_ref = refwin[tcheckidx]
-        waveform_cur = s[tcheckidx]
-        # plt.plot(tvec[tcheckidx],ii+waveform_ref,'r',label='ref')
-        # plt.plot(tvec[tcheckidx],ii+waveform_cur,'b')
-        cof[ii] = np.corrcoef(waveform_ref, waveform_cur)[0, 1]
-#         cof[ii] = np.sum(np.power(waveform_ref-waveform_cur,2))
-    #
-    # plt.grid()
-    # plt.show()
-    cdp = np.corrcoef(curwin, refwin)[0, 1] # correlation coefficient between the reference and initial current waveforms
+    # correlation coefficients of the stretched/compressed current waveforms
+    cof = _stretch_cof(tvec,refwin,curwin,Eps)
+    cdp = _pearson(curwin, refwin) # correlation coefficient between the reference and initial current waveforms
 
     # find the maximum correlation coefficient
     imax = np.nanargmax(cof)
@@ -486,22 +461,9 @@ def ts_dvv(ref, cur, t,twin, freq, dvmax=0.05, ndv=100, filter=True):
         imax = imax - 2
     if imax <= 2:
         imax = imax + 2
-    #
-    # plt.plot(Eps,cof,'o')
-    # plt.show()
     # Proceed to the second step to get a more precise dv/v measurement
     dtfiner = np.linspace(Eps[imax-2], Eps[imax+2], ndv)
-    ncof    = np.zeros(dtfiner.shape,dtype=np.float32)
-
-    for ii in range(len(dtfiner)):
-        nt = tvec*dtfiner[ii]
-        s = np.interp(x=tvec, xp=nt, fp=curwin)
-        tcheckmin=np.max([nt[0],tvec[0]])
-        tcheckmax=np.min([nt[-1],tvec[-1]])
-        tcheckidx=np.where((tvec>= tcheckmin) & (tvec<=tcheckmax))[0]
-        waveform_ref = refwin[tcheckidx]
-        waveform_cur = s[tcheckidx]
-        ncof[ii] = np.corrcoef(waveform_ref, waveform_cur)[0, 1]
+    ncof    = _stretch_cof(tvec,refwin,curwin,dtfiner)
     cc = np.max(ncof) # Find maximum correlation coefficient of the refined  analysis
     dv = 100. * dtfiner[np.argmax(ncof)]-100 # Multiply by 100 to convert to percentage (Epsilon = -dt/t = dv/v)
 
@@ -509,13 +471,78 @@ def ts_dvv(ref, cur, t,twin, freq, dvmax=0.05, ndv=100, filter=True):
     T = 1 / (fmax - fmin)
     X = cc
     wc = np.pi * (fmin + fmax)
-    t1 = np.min([tmin, tmax])
-    t2 = np.max([tmin, tmax])
+    t1 = min(tmin, tmax)
+    t2 = max(tmin, tmax)
     error = 100*(np.sqrt(1-X**2)/(2*X)*np.sqrt((6* np.sqrt(np.pi/2)*T)/(wc**2*(t2**3-t1**3))))
 
     return dv, error, cc, cdp
 
-def wts_dvv(ref,cur,t,twin,freq,subfreq=True,dvmax=0.05,normalize=True,ndv=100,dj=1/12,s0=-1,J=-1,wvn='morlet'):
+def _pearson(a,b):
+    """
+    Pearson correlation coefficient between a and b, same as np.corrcoef(a,b)[0,1]
+    without building the covariance matrix. b can be 2-D, with one coefficient
+    returned for each row.
+    """
+    a = np.asarray(a,dtype=np.float64)
+    b = np.asarray(b,dtype=np.float64)
+    am = a - a.mean()
+    bm = b - b.mean(axis=-1,keepdims=True)
+    return (bm @ am) / np.sqrt((am @ am) * np.einsum('...i,...i->...',bm,bm))
+
+def _stretch_cof(tvec,ref,cur,eps):
+    """
+    Correlation coefficients between ref and cur stretched by each factor in eps.
+    The stretched trace is correlated with ref only where tvec overlaps tvec*eps[i]
+    (i.e., dropping the samples padded by the extrapolation). The overlap is a
+    contiguous slice of tvec, so it is located with searchsorted instead of a mask.
+    """
+    cof = np.zeros(len(eps),dtype=np.float32)
+    for ii in range(len(eps)):
+        nt = tvec*eps[ii]
+        s = np.interp(x=tvec, xp=nt, fp=cur)
+        #trim the zero paddings due to extrapolation.
+        i0 = np.searchsorted(tvec,max(nt[0],tvec[0]),side='left')
+        i1 = np.searchsorted(tvec,min(nt[-1],tvec[-1]),side='right')
+        cof[ii] = _pearson(ref[i0:i1],s[i0:i1])
+
+    return cof
+
+def _cwt_pair(cur,ref,dt,dj=1/12,s0=-1,J=-1,wvn='morlet',dtype=np.complex64):
+    """
+    Continuous wavelet transforms of cur and ref, same as pycwt.cwt() on each of them,
+    but the scaled wavelet spectra are built once and shared by the two traces.
+    The transforms are computed in dtype, complex64 by default, which is ample for
+    the stretching and halves the size of the (2, nscale, N) transform.
+    Returns the transforms of cur and ref, the scales and the Fourier frequencies.
+    """
+    wavelet = _check_parameter_wavelet(wvn)
+    n0 = len(cur)
+    if s0 == -1:
+        s0 = 2 * dt / wavelet.flambda()
+    if J == -1:
+        J = int(round(math.log2(n0 * dt / s0) / dj))
+    sj = s0 * 2 ** (np.arange(0, J + 1) * dj)
+    freqs = 1 / (wavelet.flambda() * sj)
+
+    # pad to the next power of 2 as pycwt does.
+    N = 2 ** math.ceil(math.log2(n0))
+    signal_ft = fft(np.vstack((cur,ref)).astype(np.finfo(dtype).dtype), N, axis=1, workers=-1)
+    ftfreqs = 2 * np.pi * fftfreq(N, dt)
+    sj_col = sj[:, None]
+    psi_ft_bar = (sj_col * ftfreqs[1] * N) ** 0.5 * np.conjugate(wavelet.psi_ft(sj_col * ftfreqs))
+    psi_ft_bar = psi_ft_bar.astype(dtype, copy=False)
+    W = ifft(signal_ft[:,None,:] * psi_ft_bar, axis=2, overwrite_x=True, workers=-1)
+    # remove scales with NaN over the whole transform
+    sel = np.invert(np.isnan(W).all(axis=2).any(axis=0))
+    if np.any(sel):
+        sj = sj[sel]
+        freqs = freqs[sel]
+        W = W[:, sel, :]
+
+    return W[0, :, :n0], W[1, :, :n0], sj, freqs
+
+def wts_dvv(ref,cur,t,twin,freq,subfreq=True,dvmax=0.05,normalize=True,ndv=100,dj=1/12,s0=-1,J=-1,wvn='morlet',
+            nthread=None):
     """
     Apply stretching method to continuous wavelet transformation (CWT) of signals
     for all frequecies in an interest range
@@ -533,6 +560,9 @@ def wts_dvv(ref,cur,t,twin,freq,subfreq=True,dvmax=0.05,normalize=True,ndv=100,d
     ndv: number of stretching coefficient between dvmin and dvmax, no need to be higher than 100  (Default)
     dj, s0, J, sig, wvn: common parameters used in 'wavelet.wct'. Defaults are dj=1/12,s0=-1,J=-1,wvn='morlet'
     normalize: normalize the wavelet spectrum or not. Default is True
+    nthread: number of threads to run the stretching of the frequencies in parallel when subfreq
+            is True. Default is None (serial loop). Keep it None when wts_dvv() itself runs in
+            parallel processes, e.g., get_dvv() with nproc.
 
     RETURNS:
     ------------------
@@ -544,15 +574,14 @@ def wts_dvv(ref,cur,t,twin,freq,subfreq=True,dvmax=0.05,normalize=True,ndv=100,d
     """
     # common variables
     dt   = t[1]-t[0]
-    tmin = np.min(twin)
-    tmax = np.max(twin)
-    fmin = np.min(freq)
-    fmax = np.max(freq)
-    itvec = np.arange(np.int((tmin-t.min())/dt)+1, np.int((tmax-t.min())/dt)+1)
+    tmin = min(twin)
+    tmax = max(twin)
+    fmin = min(freq)
+    fmax = max(freq)
+    itvec = np.arange(int((tmin-t.min())/dt)+1, int((tmax-t.min())/dt)+1)
 
     # apply cwt on two traces
-    cwt1, sj, f, coi, _, _ = pycwt.cwt(cur, dt, dj, s0, J, wvn)
-    cwt2, sj, f, coi, _, _ = pycwt.cwt(ref, dt, dj, s0, J, wvn)
+    cwt1, cwt2, sj, f = _cwt_pair(cur, ref, dt, dj, s0, J, wvn)
 
     # zero out data outside frequency band
     if (fmax> np.max(f)) | (fmax <= fmin):
@@ -585,12 +614,12 @@ def wts_dvv(ref,cur,t,twin,freq,subfreq=True,dvmax=0.05,normalize=True,ndv=100,d
     # directly take advantage of the real-valued parts of wavelet transforms
     else:
         # extract real values of cwt
-        rcwt1, rcwt2 = np.real(cwt1), np.real(cwt2)
-        # initialize variable
-        nfreq=len(f_ind)
-        dvv, cc, cdp, err = np.zeros(nfreq,dtype=np.float32), np.zeros(nfreq,dtype=np.float32),\
-            np.zeros(nfreq,dtype=np.float32),np.zeros(nfreq,dtype=np.float32)
+        # single precision is enough for the stretching and halves the memory traffic of
+        # the per-frequency rows, which are also made contiguous here.
+        rcwt1 = np.ascontiguousarray(np.real(cwt1),dtype=np.float32)
+        rcwt2 = np.ascontiguousarray(np.real(cwt2),dtype=np.float32)
         # loop through each freq
+        tsargs=[]
         for ii, ifreq in enumerate(f_ind):
 
             # prepare windowed data
@@ -606,16 +635,23 @@ def wts_dvv(ref,cur,t,twin,freq,subfreq=True,dvmax=0.05,normalize=True,ndv=100,d
             #update the frequency to be passed to ts_dvv(). the frequency range is used to compute the errors.
             if ii >0:
                 if ii < len(f_ind) - 1:
-                    newfreq=[np.mean([f[ifreq],f[f_ind[ii-1]]]),np.mean([f[ifreq],f[f_ind[ii+1]]])]
+                    newfreq=[0.5*(f[ifreq]+f[f_ind[ii-1]]),0.5*(f[ifreq]+f[f_ind[ii+1]])]
                 else:
                     df=np.abs(f[f_ind[ii]] - f[f_ind[ii-1]])
-                    newfreq=[np.mean([f[ifreq],f[f_ind[ii-1]]]),f[ifreq]+0.5*df]
+                    newfreq=[0.5*(f[ifreq]+f[f_ind[ii-1]]),f[ifreq]+0.5*df]
             else:
                 df=np.abs(f[f_ind[ii+1]] - f[f_ind[ii]])
-                newfreq=[f[ifreq]-0.5*df,np.mean([f[ifreq],f[f_ind[ii+1]]])]
-            # run stretching
-            dv, error, c1, c2 = ts_dvv(ncwt2, ncwt1, t,twin,newfreq, dvmax=dvmax, ndv=ndv,filter=False)
-            dvv[ii], err[ii], cc[ii], cdp[ii]=dv, error,c1, c2
+                newfreq=[f[ifreq]-0.5*df,0.5*(f[ifreq]+f[f_ind[ii+1]])]
+            tsargs.append((ncwt2, ncwt1, t,twin,newfreq,dvmax,ndv,False))
+        # run stretching. the frequencies are independent and ts_dvv() spends its time in
+        # numpy, so threads share the cwt arrays without copying them.
+        if nthread is None or nthread<2:
+            results=[ts_dvv(*a) for a in tsargs]
+        else:
+            with ThreadPool(int(nthread)) as p:
+                results=p.starmap(ts_dvv,tsargs)
+        #reshape keeps the empty results (no frequency in the band) unpackable.
+        dvv, err, cc, cdp = np.array(results,dtype=np.float32).reshape(-1,4).T
 
         return f[f_ind], dvv, err, cc, cdp
 
@@ -643,10 +679,10 @@ def xc_dvv(ref, cur, t,twin, freq, filter=True,plot=False):
 
     # load common variables from dictionary
     dt   = t[1]-t[0]
-    tmin = np.min(twin)
-    tmax = np.max(twin)
-    fmin = np.min(freq)
-    fmax = np.max(freq)
+    tmin = min(twin)
+    tmax = max(twin)
+    fmin = min(freq)
+    fmax = max(freq)
     itvec = np.arange(int((tmin-t.min())/dt)+1, int((tmax-t.min())/dt)+1)
     tvec = t[itvec]
 
@@ -658,7 +694,7 @@ def xc_dvv(ref, cur, t,twin, freq, filter=True,plot=False):
     curwin_temp=cur[itvec]
     refwin=refwin_temp/np.max(np.abs(refwin_temp))
     curwin=curwin_temp/np.max(np.abs(curwin_temp))
-    cdp = np.corrcoef(curwin, refwin)[0, 1] # correlation coefficient between the reference and initial current waveforms
+    cdp = _pearson(curwin, refwin) # correlation coefficient between the reference and initial current waveforms
 
     #
     winlen=int(2/freq[0]/dt)
@@ -666,21 +702,18 @@ def xc_dvv(ref, cur, t,twin, freq, filter=True,plot=False):
     sliceref,slicen,sliceidx=utils.sliding_window(refwin,winlen,ss=step,getindex=True)
     slicecur,slicen,sliceidx=utils.sliding_window(curwin,winlen,ss=step,getindex=True)
     lags = dt*correlation_lags(winlen, winlen)
-    dtarray=[]
-    tarray=[]
-    cc_all=[]
-    for i in range(slicen-1):
-        xc = correlate(slicecur[i],sliceref[i])
-        cc_all.append(np.max(xc))
-
-        xcmax=np.nanargmax(xc)
-        xcmaxlag=lags[xcmax]
-        dtarray.append(xcmaxlag)
-        tarray.append(tvec[sliceidx[i]])
+    # cross-correlate all windows at once in the frequency domain. the circular
+    # correlation of length Nfft>=2*winlen-1 holds the full linear correlation, with
+    # the negative lags wrapped to the end.
+    Nfft=next_fast_len(2*winlen-1,real=True)
+    xc = irfft(rfft(slicecur[:slicen-1],Nfft,axis=1,workers=-1)*np.conj(rfft(sliceref[:slicen-1],Nfft,axis=1,workers=-1)),
+               Nfft,axis=1,workers=-1)
+    xc = np.concatenate((xc[:,Nfft-winlen+1:],xc[:,:winlen]),axis=1)
+
+    dtarray=lags[np.nanargmax(xc,axis=1)]
+    tarray=tvec[sliceidx[:slicen-1]]
 
     #
-    tarray=np.array(tarray)
-    dtarray=np.array(dtarray)
     res=linregress(tarray,dtarray)
     if plot:
         plt.figure()
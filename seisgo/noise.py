@@ -7,8 +7,7 @@ import datetime
 import numpy as np
 import pandas as pd
 from obspy.signal.invsim import cosine_taper
-from obspy.signal.regression import linear_regression
-from scipy.fftpack import fft,ifft,next_fast_len
+from scipy.fft import irfft
 from seisgo import stacking as stack
 from seisgo.types import CorrData, FFTData
 from seisgo import utils,helpers
@@ -123,20 +122,20 @@ def smooth_source_spect(fft1,cc_method,sn):
 
     N=fft1.shape[0]
     Nfft2=fft1.shape[1]
-    fft1=fft1.reshape(fft1.size)
+    fft1=fft1.ravel()
     if cc_method == 'deconv':
 
         #-----normalize single-station cc to z component-----
-        temp = utils.moving_ave(np.abs(fft1),smoothspect_N)
+        temp = utils.moving_ave(np.abs(fft1),smoothspect_N).astype(np.float32,copy=False)
         try:
-            sfft1 = fft1/temp**2
+            sfft1 = np.divide(fft1,np.square(temp,out=temp))
         except Exception:
             raise ValueError('smoothed spectrum has zero values')
 
     elif cc_method == 'coherency':
-        temp = utils.moving_ave(np.abs(fft1),smoothspect_N)
+        temp = utils.moving_ave(np.abs(fft1),smoothspect_N).astype(np.float32,copy=False)
         try:
-            sfft1 = fft1/temp
+            sfft1 = np.divide(fft1,temp)
         except Exception:
             raise ValueError('smoothed spectrum has zero values')
 
@@ -286,18 +285,19 @@ def correlate(fftdata1,fftdata2,maxlag,method='xcorr',substack=False,
     #
     dist,azi,baz = obspy.geodetics.base.gps2dist_azimuth(fftdata1.lat,fftdata1.lon,fftdata2.lat,fftdata2.lon)
     #---------- check the existence of earthquakes by std of the data.----------
+    #nan std fails both comparisons, so it is excluded as well.
     source_std = fftdata1.std[ind1]
-    sou_ind = np.where((source_std<maxstd)&(source_std>0)&(np.isnan(source_std)==0))[0]
-    if not len(sou_ind): return corrdata
+    sou_good = (source_std<maxstd)&(source_std>0)
+    if not np.any(sou_good): return corrdata
 
     receiver_std = fftdata2.std[ind2]
-    rec_ind = np.where((receiver_std<maxstd)&(receiver_std>0)&(np.isnan(receiver_std)==0))[0]
-    if not len(rec_ind): return corrdata
-    bb=np.intersect1d(sou_ind,rec_ind)
+    rec_good = (receiver_std<maxstd)&(receiver_std>0)
+    if not np.any(rec_good): return corrdata
+    bb=np.nonzero(sou_good&rec_good)[0]
     if len(bb)==0:return corrdata
 
-    bb_data1=[ind1[i] for i in bb]
-    bb_data2=[ind2[i] for i in bb]
+    bb_data1=np.asarray(ind1)[bb]
+    bb_data2=np.asarray(ind2)[bb]
 
     #----load paramters----
     dt      = fftdata1.dt
@@ -308,7 +308,8 @@ def correlate(fftdata1,fftdata2,maxlag,method='xcorr',substack=False,
     Nfft = fftdata1.Nfft
     Nfft2 = Nfft//2
 
-    fft1=np.conj(fftdata1.data[bb_data1,:Nfft2]) #get the conjugate of fft1
+    fft1=fftdata1.data[bb_data1,:Nfft2]
+    np.conj(fft1,out=fft1) #get the conjugate of fft1, in the copy from the fancy indexing.
     nwin  = fft1.shape[0]
     fft2=fftdata2.data[bb_data2,:Nfft2]
 
@@ -316,38 +317,24 @@ def correlate(fftdata1,fftdata2,maxlag,method='xcorr',substack=False,
 
     if method != "xcorr":
         fft1 = smooth_source_spect(fft1,method,smoothspect_N)
-    #------convert all 2D arrays into 1D to speed up--------
-    corr = np.zeros(nwin*Nfft2,dtype=np.complex64)
-    corr = fft1.reshape(fft1.size,)*fft2.reshape(fft2.size,)
+    # fft1 is a local array, reuse its buffer for the cross spectrum.
+    corr = np.multiply(fft1,fft2,out=fft1)
 
     if method == "coherency":
-        temp = utils.moving_ave(np.abs(fft2.reshape(fft2.size,)),smoothspect_N)
-        corr /= temp
-    corr  = corr.reshape(nwin,Nfft2)
+        #------the smoothing runs over the 1D flattened spectra--------
+        temp = utils.moving_ave(np.abs(fft2).ravel(),smoothspect_N).astype(np.float32,copy=False)
+        np.divide(corr,temp.reshape(nwin,Nfft2),out=corr)
 
     if substack:
         if substack_len == cc_len:
             # choose to keep all fft data for a day
-            s_corr = np.zeros(shape=(nwin,Nfft),dtype=np.float32)   # stacked correlation
-            ampmax = np.zeros(nwin,dtype=np.float32)
-            n_corr = np.zeros(nwin,dtype=np.int16)                  # number of correlations for each substack
+            n_corr = np.ones(nwin,dtype=np.int16)                   # number of correlations for each substack
             t_corr = timestamp                                        # timestamp
-            crap   = np.zeros(Nfft,dtype=np.complex64)
-            for i in range(nwin):
-                n_corr[i]= 1
-                crap[:Nfft2] = corr[i,:]
-                # if dist > 0: # remove the mean in freq domain (spike at t=0). only for cross-station correlations.
-                #     crap[:Nfft2] = crap[:Nfft2]-np.mean(crap[:Nfft2])
-                crap[-(Nfft2)+1:] = np.flip(np.conj(crap[1:(Nfft2)]),axis=0)
-                crap[0]=complex(0,0)
-                s_corr[i,:] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
-
-            # remove abnormal data
-            ampmax = np.max(s_corr,axis=1)
-            tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
-            s_corr = s_corr[tindx,:]
-            t_corr = t_corr[tindx]
-            n_corr = n_corr[tindx]
+            # if dist > 0: # remove the mean in freq domain (spike at t=0). only for cross-station correlations.
+            #     corr -= np.mean(corr,axis=1,keepdims=True)
+            corr[:,0]=complex(0,0)
+            # one batched inverse real FFT over all windows. irfft implies the Hermitian symmetry.
+            s_corr = irfft(corr, Nfft, axis=1, workers=-1)
 
         else:
             # get time information
@@ -355,54 +342,60 @@ def correlate(fftdata1,fftdata2,maxlag,method='xcorr',substack=False,
             tstart = timestamp[0]
 
             nstack = int(np.round(Ttotal/substack_len))
-            ampmax = np.zeros(nstack,dtype=np.float32)
-            s_corr = np.zeros(shape=(nstack,Nfft),dtype=np.float32)
-            n_corr = np.zeros(nstack,dtype=np.int)
-            t_corr = np.zeros(nstack,dtype=np.float)
-            crap   = np.zeros(Nfft,dtype=np.complex64)
-
-            for istack in range(nstack):
-                # find the indexes of all of the windows that start or end within
-                itime = np.where( (timestamp >= tstart) & (timestamp < tstart+substack_len) )[0]
-                if len(itime)==0:tstart+=substack_len;continue
-
-                crap[:Nfft2] = np.mean(corr[itime,:],axis=0)   # linear average of the correlation
-                # if dist > 0: crap[:Nfft2] = crap[:Nfft2]-np.mean(crap[:Nfft2])   # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2)+1:]=np.flip(np.conj(crap[1:(Nfft2)]),axis=0)
-                crap[0]=complex(0,0)
-                s_corr[istack,:] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
-                n_corr[istack] = len(itime)               # number of windows stacks
-                t_corr[istack] = tstart                   # save the time stamps
-                tstart += substack_len
-                #print('correlation done and stacked at time %s' % str(t_corr[istack]))
-
-            # remove abnormal data
-            ampmax = np.max(s_corr,axis=1)
-            tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
-            s_corr = s_corr[tindx,:]
-            t_corr = t_corr[tindx]
-            n_corr = n_corr[tindx]
+            # assign each window to the substack it starts in, then sum the windows of all
+            # substacks at once. empty substacks keep zeros.
+            tedges = tstart+substack_len*np.arange(nstack+1)
+            # bin against edges in the precision of the timestamps, accumulated one substack
+            # at a time. at modern epochs a float32 timestamp has a ULP of ~128 s, so exact
+            # float64 edges would move windows sitting on a boundary into the previous substack.
+            bedges = np.cumsum(np.append(tstart,np.full(nstack,substack_len)).astype(timestamp.dtype),
+                               dtype=timestamp.dtype)
+            istack = np.searchsorted(bedges,timestamp,side='right')-1
+            iuse   = np.where((istack>=0) & (istack<nstack))[0]
+            iuse   = iuse[np.argsort(istack[iuse],kind='stable')]
+            istack = istack[iuse]
+            n_corr = np.bincount(istack,minlength=nstack)        # number of windows stacks
+            t_corr = np.zeros(nstack,dtype=np.float64)
+            crap   = np.zeros(shape=(nstack,Nfft2),dtype=np.complex64)
+            if len(iuse):
+                ifirst = np.where(np.diff(istack,prepend=-1)>0)[0]
+                igood  = istack[ifirst]
+                # linear average of the correlation
+                crap[igood] = np.add.reduceat(corr[iuse],ifirst,axis=0)/n_corr[igood,None]
+                # if dist > 0: crap[igood] -= np.mean(crap[igood],axis=1,keepdims=True)   # remove the mean in freq domain (spike at t=0)
+                t_corr[igood] = tedges[igood]             # save the time stamps
+            crap[:,0]=complex(0,0)
+            # inverse FFT of all substacks in one call. empty substacks stay as zeros.
+            s_corr = irfft(crap, Nfft, axis=1, workers=-1)
+
+        # remove abnormal data. s_corr is masked when trimming to only copy the kept traces.
+        ampmax = np.max(s_corr,axis=1)
+        tindx  = (ampmax<20*np.median(ampmax)) & (ampmax>0)
+        t_corr = t_corr[tindx]
+        n_corr = n_corr[tindx]
 
     else:
         # average daily cross correlation functions
         ampmax = np.max(corr,axis=1)
         tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
         n_corr = nwin
-        s_corr = np.zeros(Nfft,dtype=np.float32)
         t_corr = timestamp[0]
-        crap   = np.zeros(Nfft,dtype=np.complex64)
-        crap[:Nfft2] = np.mean(corr[tindx],axis=0)
-        # if dist > 0: crap[:Nfft2] = crap[:Nfft2]-np.mean(crap[:Nfft2],axis=0)
-        crap[-(Nfft2)+1:]=np.flip(np.conj(crap[1:(Nfft2)]),axis=0)
-        s_corr = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+        crap   = np.mean(corr[tindx],axis=0)
+        # if dist > 0: crap -= np.mean(crap)
+        s_corr = irfft(crap, Nfft, workers=-1)
 
     # trim the CCFs in [-maxlag maxlag]
     t = np.arange(-Nfft2+1, Nfft2)*dt
     ind = np.where(np.abs(t) <= maxlag)[0]
+    # s_corr is not shifted after the ifft: zero lag is the first sample and the negative
+    # lags wrap around to the end. pick the lags directly instead of copying with ifftshift.
+    # this is cheaper than centering with a (-1)**k phase ramp on the spectrum, which costs
+    # one more pass over all frequencies and is only an exact shift for even Nfft.
+    ind = (ind+Nfft2)%Nfft
     if s_corr.ndim==1:
         s_corr = s_corr[ind]
     elif s_corr.ndim==2:
-        s_corr = s_corr[:,ind]
+        s_corr = s_corr[np.ix_(tindx,ind)]
 
     ### call CorrData to build the object
     cc_comp= fftdata1.chan[-1]+fftdata2.chan[-1]
@@ -598,8 +591,8 @@ def stacking(corrdata,method='linear',par=None):
             dstack[i,:]=corrdata.data[:]
     else:
         ampmax = np.max(corrdata.data,axis=1)
-        tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
-        nstacks=len(tindx)
+        tindx  = (ampmax<20*np.median(ampmax)) & (ampmax>0)
+        nstacks=np.count_nonzero(tindx)
         dstack=[]
         cc_time=[]
         if nstacks >0:
@@ -663,17 +656,25 @@ def rotation(bigstack,parameters,locs,flag):
         cosb = np.cos(baz*pi/180)
         sinb = np.sin(baz*pi/180)
 
-    # rtz_components = ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ']
+    # the mixing from the E-N-Z components ['EE','EN','EZ','NE','NN','NZ','ZE','ZN','ZZ']
+    # to the R-T-Z components ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ'] is block diagonal.
+    # only the non-zero blocks are applied, sharing the products of the angle terms.
+    bigstack = np.asarray(bigstack,dtype=np.float32)
+    cacb,casb,sacb,sasb = cosa*cosb,cosa*sinb,sina*cosb,sina*sinb
     tcorr = np.zeros(shape=(9,npts),dtype=np.float32)
-    tcorr[0] = -cosb*bigstack[7]-sinb*bigstack[6]
-    tcorr[1] = sinb*bigstack[7]-cosb*bigstack[6]
+    # ZR, ZT from ZE, ZN
+    tcorr[0:2] = np.array([[-sinb,-cosb],
+                           [-cosb,sinb]],dtype=np.float32) @ bigstack[6:8]
+    # ZZ
     tcorr[2] = bigstack[8]
-    tcorr[3] = -cosa*cosb*bigstack[4]-cosa*sinb*bigstack[3]-sina*cosb*bigstack[1]-sina*sinb*bigstack[0]
-    tcorr[4] = cosa*sinb*bigstack[4]-cosa*cosb*bigstack[3]+sina*sinb*bigstack[1]-sina*cosb*bigstack[0]
-    tcorr[5] = cosa*bigstack[5]+sina*bigstack[2]
-    tcorr[6] = sina*cosb*bigstack[4]+sina*sinb*bigstack[3]-cosa*cosb*bigstack[1]-cosa*sinb*bigstack[0]
-    tcorr[7] = -sina*sinb*bigstack[4]+sina*cosb*bigstack[3]+cosa*sinb*bigstack[1]-cosa*cosb*bigstack[0]
-    tcorr[8] = -sina*bigstack[5]+cosa*bigstack[2]
+    # RR, RT, TR, TT from EE, EN, NE, NN
+    tcorr[[3,4,6,7]] = np.array([[-sasb,-sacb,-casb,-cacb],
+                                 [-sacb,sasb,-cacb,casb],
+                                 [-casb,-cacb,sasb,sacb],
+                                 [-cacb,casb,sacb,-sasb]],dtype=np.float32) @ bigstack[[0,1,3,4]]
+    # RZ, TZ from EZ, NZ
+    tcorr[[5,8]] = np.array([[sina,cosa],
+                             [cosa,-sina]],dtype=np.float32) @ bigstack[[2,5]]
 
     return tcorr
 
@@ -941,46 +942,19 @@ def save_xcorr_amplitudes(dict_in,filenamebase=None):
 
     cc_comp=list(dict_in['cc_comp'].keys())
 
+    columns=['source','lonS','latS','eleS','receiver','lonR','latR','eleR','az','baz','dist',
+            'peakamp_neg','peakamp_pos','peaktt_neg','peaktt_pos','comp']
     for ic in range(len(cc_comp)):
         comp = cc_comp[ic]
-        receivers=list(dict_in['cc_comp'][comp].keys())
-        lonS=lonS0*np.ones((len(receivers),))
-        latS=latS0*np.ones((len(receivers),))
-        eleS=eleS0*np.ones((len(receivers),))
-        comp_out=len(receivers)*[comp]
-        source_out=len(receivers)*[source]
-
-        lonR=[]
-        latR=[]
-        eleR=[]
-        dist=[]
-        peakamp_neg=[]
-        peakamp_pos=[]
-        peaktt_neg=[]
-        peaktt_pos=[]
-        az=[]
-        baz=[]
-
-        for ir in range(len(receivers)):
-            receiver=receivers[ir]
-            dist0=dict_in['cc_comp'][comp][receiver]['dist']
-            dist.append(dist0)
-            lonR.append(dict_in['cc_comp'][comp][receiver]['location'][0])
-            latR.append(dict_in['cc_comp'][comp][receiver]['location'][1])
-            eleR.append(0.0)
-            az.append(dict_in['cc_comp'][comp][receiver]['az'])
-            baz.append(dict_in['cc_comp'][comp][receiver]['baz'])
-            peakamp_neg.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude'])[0])
-            peakamp_pos.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude'])[1])
-            peaktt_neg.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude_time'])[0])
-            peaktt_pos.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude_time'])[1])
-
-
-        outDF=pd.DataFrame({'source':source_out,'lonS':lonS,'latS':latS,'eleS':eleS,
-                           'receiver':receivers,'lonR':lonR,'latR':latR,'eleR':eleR,
-                           'az':az,'baz':baz,'dist':dist,'peakamp_neg':peakamp_neg,
-                            'peakamp_pos':peakamp_pos,'peaktt_neg':peaktt_neg,
-                            'peaktt_pos':peaktt_pos,'comp':comp_out})
+        rdict=dict_in['cc_comp'][comp]
+        #one record per receiver, built in a single pass.
+        records=[(source,float(lonS0),float(latS0),float(eleS0),receiver,
+                    rinfo['location'][0],rinfo['location'][1],0.0,rinfo['az'],rinfo['baz'],rinfo['dist'],
+                    rinfo['peak_amplitude'][0],rinfo['peak_amplitude'][1],
+                    rinfo['peak_amplitude_time'][0],rinfo['peak_amplitude_time'][1],
+                    comp) for receiver,rinfo in rdict.items()]
+
+        outDF=pd.DataFrame.from_records(records,columns=columns)
         fname=filenamebase+'_'+comp+'_peakamp.txt'
         outDF.to_csv(fname,index=False)
         print('data was saved to: '+fname)
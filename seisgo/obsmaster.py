@@ -4,7 +4,8 @@
 from seisgo import utils,downloaders
 from seisgo.types import Power,Cross,Rotation
 # from warnings import warn
-from scipy.signal import spectrogram, detrend,tukey
+from scipy.signal import spectrogram, detrend
+from scipy.signal.windows import tukey
 from scipy.linalg import norm
 import matplotlib.pyplot as plt
 import numpy as np
@@ -736,10 +737,11 @@ def getspectra(tr1,tr2,trZ,trP,window=7200,overlap=0.3,pd=[0.004, 0.2], tol=1.5,
 
     step = int(window*(1-overlap)/dt)
     out,nd,window_index = utils.sliding_window(trZ.data,ws,step,getindex=True)
-    ftZ, f = utils.calculate_windowed_fft(trZ.data,trZ.stats.sampling_rate, ws, ss=step,wind=np.hanning(ws))
-    ftP, f = utils.calculate_windowed_fft(trP.data,trP.stats.sampling_rate, ws, ss=step,wind=np.hanning(ws))
-    ft1, f = utils.calculate_windowed_fft(tr1.data,tr1.stats.sampling_rate, ws, ss=step,wind=np.hanning(ws))
-    ft2, f = utils.calculate_windowed_fft(tr2.data,tr2.stats.sampling_rate, ws, ss=step,wind=np.hanning(ws))
+    wind = np.hanning(ws)
+    ftZ, f = utils.calculate_windowed_fft(trZ.data,trZ.stats.sampling_rate, ws, ss=step,wind=wind)
+    ftP, f = utils.calculate_windowed_fft(trP.data,trP.stats.sampling_rate, ws, ss=step,wind=wind)
+    ft1, f = utils.calculate_windowed_fft(tr1.data,tr1.stats.sampling_rate, ws, ss=step,wind=wind)
+    ft2, f = utils.calculate_windowed_fft(tr2.data,tr2.stats.sampling_rate, ws, ss=step,wind=wind)
 
     # Extract good windows
     cZZ = np.abs(np.mean(ftZ[goodwins, :]*np.conj(ftZ[goodwins, :]),
@@ -1417,28 +1417,31 @@ def plot_xcorr_amplitudes(dict_in,region,fignamebase=None,format='png',distance=
 
     for ic in range(len(cc_comp)):
         comp = cc_comp[ic]
-        receivers=list(dict_in['cc_comp'][comp].keys())
-        lonR=[]
-        latR=[]
-        dist=[]
-        peakamp_neg=[]
-        peakamp_pos=[]
-        peaktt_neg=[]
-        peaktt_pos=[]
-
-        for ir in range(len(receivers)):
-            receiver=receivers[ir]
-            dist0=dict_in['cc_comp'][comp][receiver]['dist']
+        ccdict=dict_in['cc_comp'][comp]
+        receivers=list(ccdict.keys())
+        nrec=len(receivers)
+        lonR,latR,dist=np.empty(nrec),np.empty(nrec),np.empty(nrec)
+        peakamp_neg,peakamp_pos=np.empty(nrec),np.empty(nrec)
+        peaktt_neg,peaktt_pos=np.empty(nrec),np.empty(nrec)
+
+        n=0
+        for receiver in receivers:
+            rinfo=ccdict[receiver]
+            dist0=rinfo['dist']
             if distance is not None:
                 if dist0<distance[0] or dist0>distance[1]:
                     continue
-            dist.append(dist0)
-            lonR.append(dict_in['cc_comp'][comp][receiver]['location'][0])
-            latR.append(dict_in['cc_comp'][comp][receiver]['location'][1])
-            peakamp_neg.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude'])[0]*dist0)
-            peakamp_pos.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude'])[1]*dist0)
-            peaktt_neg.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude_time'])[0])
-            peaktt_pos.append(np.array(dict_in['cc_comp'][comp][receiver]['peak_amplitude_time'])[1])
+            pa=rinfo['peak_amplitude']
+            pt=rinfo['peak_amplitude_time']
+            dist[n]=dist0
+            lonR[n],latR[n]=rinfo['location'][0],rinfo['location'][1]
+            peakamp_neg[n],peakamp_pos[n]=pa[0]*dist0,pa[1]*dist0
+            peaktt_neg[n],peaktt_pos[n]=pt[0],pt[1]
+            n += 1
+        #drop the slots of receivers outside the distance range.
+        lonR,latR,dist=lonR[:n],latR[:n],dist[:n]
+        peakamp_neg,peakamp_pos=peakamp_neg[:n],peakamp_pos[:n]
+        peaktt_neg,peaktt_pos=peaktt_neg[:n],peaktt_pos[:n]
 
         if len(peakamp_neg) >= mindatapoints:
             #amplitudes map views
@@ -3,7 +3,7 @@ import numpy as np
 from seisgo.utils import rms
 import matplotlib.pyplot as plt
 from scipy.signal import hilbert
-from scipy.fftpack import fft,ifft,next_fast_len
+from scipy.fft import fft,ifft,next_fast_len
 from stockwell import st
 from tslearn.utils import to_time_series, to_time_series_dataset
 from tslearn.clustering import TimeSeriesKMeans
@@ -156,10 +156,10 @@ def adaptive_filter(d,g=1):
         return d
     N,M = d.shape
     if N>=2:
-        Nfft = next_fast_len(M)
+        Nfft = next_fast_len(M,real=True)
 
         # fft the 2D array
-        spec = fft(d,axis=1,n=Nfft)[:,:M]
+        spec = fft(d,axis=1,n=Nfft,workers=-1)[:,:M]
 
         # make cross-spectrm matrix
         cspec = np.zeros(shape=(N*N,M),dtype=np.complex64)
@@ -181,7 +181,7 @@ def adaptive_filter(d,g=1):
         p = np.power((S1-S2)/(S2*(N-1)),g)
 
         # make ifft
-        narr = np.real(ifft(np.multiply(p,spec),Nfft,axis=1)[:,:M])
+        narr = np.real(ifft(np.multiply(p,spec),Nfft,axis=1,workers=-1)[:,:M])
         newstack=np.mean(narr,axis=0)
     else:
         newstack=d[0].copy()
@@ -215,7 +215,7 @@ def pws(d,p=2):
         return d
     N,M = d.shape
     if N >=2:
-        analytic = hilbert(d,axis=1, N=next_fast_len(M))[:,:M]
+        analytic = hilbert(d,axis=1, N=next_fast_len(M,real=True))[:,:M]
         phase = np.angle(analytic)
         phase_stack = np.mean(np.exp(1j*phase),axis=0)
         phase_stack = np.abs(phase_stack)**(p)
@@ -236,7 +236,7 @@ def nroot(d,p=2):
     Parameters:
     ------------
     d: numpy.ndarray contains the 2D cross correlation matrix
-    p: np.int, nth root for the stacking. Default is 2.
+    p: int, nth root for the stacking. Default is 2.
 
     Returns:
     ------------
@@ -282,7 +282,7 @@ def selective(d,cc_min,epsilon=1E-5,maxstep=10,win=None,stat=False,ref=None):
     RETURNS:
     ----------------------
     newstack: numpy vector contains the stacked cross correlation
-    nstep: np.int, total number of iterations for the stacking
+    nstep: int, total number of iterations for the stacking
 
     Originally ritten by Marine Denolle
     Modified by Chengxin Jiang @Harvard (Oct2020)
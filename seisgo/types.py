@@ -5,7 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from obspy.io.sac.sactrace import SACTrace
 from obspy.signal.filter import bandpass,highpass,lowpass
-from scipy.fftpack import fft,ifft,fftfreq,next_fast_len
+from scipy.fft import rfft,fftfreq,next_fast_len
 from seisgo import utils,stacking,helpers
 from obspy import UTCDateTime
 from scipy import signal
@@ -104,6 +104,9 @@ class FFTData(object):
     """
     Object to store FFT data. The idea of having a FFTData data type
     was originally designed by Tim Clements for SeisNoise.jl (https://github.com/tclements/SeisNoise.jl).
+
+    The data attribute only keeps the non-negative frequencies of the real-input FFT,
+    with the shape of [nseg, Nfft//2+1].
     """
     def __init__(self,trace=None,win_len=None,step=None,stainv=None,
                 id=None,net=None,sta=None,loc=None,chan=None,lon=None,lat=None,ele=None,
@@ -201,7 +204,6 @@ class FFTData(object):
                                                         taper_frac=taper_frac)        # optimized version:3-4 times faster
 
         if len(dataS)>0:
-            N=dataS.shape[0]
             self.std=trace_stdS
             self.time=dataS_t
             #------to normalize in time or not------
@@ -209,9 +211,7 @@ class FFTData(object):
                 if time_norm == 'one_bit': 	# sign normalization
                     white = np.sign(dataS)
                 elif time_norm == 'rma': # running mean: normalization over smoothed absolute average
-                    white = np.zeros(shape=dataS.shape,dtype=dataS.dtype)
-                    for kkk in range(N):
-                        white[kkk,:] = dataS[kkk,:]/utils.moving_ave(np.abs(dataS[kkk,:]),smooth)
+                    white = dataS/utils.moving_ave2d(np.abs(dataS),smooth)
                 elif time_norm == 'ftn':
                     white = dataS
                 else:
@@ -227,8 +227,10 @@ class FFTData(object):
             elif white.ndim == 2:
                 axis = 1
 
-            Nfft = int(next_fast_len(int(dataS.shape[axis])))
-            fft_white = fft(white, Nfft, axis=axis) # return FFT
+            Nfft = int(next_fast_len(int(dataS.shape[axis]),real=True))
+            white = np.ascontiguousarray(white,dtype=np.float32)
+            # only keep the non-negative frequencies (Nfft//2+1) since the input is real.
+            fft_white = rfft(white, Nfft, axis=axis, workers=-1) # return FFT
 
             ##
             self.data=fft_white
@@ -288,17 +290,12 @@ class FFTData(object):
             if freq_norm == 'phase_only':
                 FFTRawSign[:,left:right] = np.exp(1j * np.angle(FFTRawSign[:,left:right]))
             elif freq_norm == 'rma':
-                for ii in range(self.data.shape[0]):
-                    tave = utils.moving_ave(np.abs(FFTRawSign[ii,left:right]),smooth)
-                    FFTRawSign[ii,left:right] = FFTRawSign[ii,left:right]/tave
+                FFTRawSign[:,left:right] /= utils.moving_ave2d(np.abs(FFTRawSign[:,left:right]),smooth)
             # Right tapering:
             FFTRawSign[:,right:high] = np.cos(
                 np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
                 1j * np.angle(FFTRawSign[:,right:high]))
             FFTRawSign[:,high:Nfft//2] *= 0
-
-            # Hermitian symmetry (because the input is real)
-            FFTRawSign[:,-(Nfft//2)+1:] = np.flip(np.conj(FFTRawSign[:,1:(Nfft//2)]),axis=axis)
         else:
             FFTRawSign[0:low] *= 0
             FFTRawSign[low:left] = np.cos(
@@ -315,9 +312,6 @@ class FFTData(object):
                 np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
                 1j * np.angle(FFTRawSign[right:high]))
             FFTRawSign[high:Nfft//2] *= 0
-
-            # Hermitian symmetry (because the input is real)
-            FFTRawSign[-(Nfft//2)+1:] = FFTRawSign[1:(Nfft//2)].conjugate()[::-1]
         ##re-assign back to self.data.
         self.data=FFTRawSign
 
@@ -763,12 +757,15 @@ class CorrData(object):
                     win=np.arange(self.time[0],self.time[-1]+0.5*win_len,win_len)  #all time chunks
                 else:
                     win=np.array([self.time[0]])
-                ts_temp=[]
                 ds=np.ndarray((len(win),self.data.shape[1]),dtype=self.data.dtype)
                 ds.fill(np.nan)
-                ngood=[]
+                ngood=np.zeros(len(win),dtype=bool)
+                # sort the traces into the time chunks once, instead of searching all traces for each chunk.
+                iwin=np.searchsorted(win,self.time,side='right')-1
+                isort=np.argsort(iwin,kind='stable')
+                ibound=np.searchsorted(iwin[isort],np.arange(len(win)))
                 for i in range(len(win)-1):
-                    widx=np.where((self.time>=win[i]) & (self.time<win[i]+win_len))[0]
+                    widx=isort[ibound[i]:ibound[i+1]]
                     if len(widx) >0:
                         if demean:
                             cc0 = utils.demean(self.data[widx,:])
@@ -790,17 +787,16 @@ class CorrData(object):
                                 dstack = stacking.seisstack(cc_array,method=method,par=stack_par)
 
                             ds[i,:]=dstack
-                            ngood.append(i)
-                            ts_temp.append(win[i])
+                            ngood[i]=True
 
                 #
-                ts=np.array(ts_temp)
+                ts=win[ngood]
                 ds=ds[ngood,:]
 
                 if overwrite:
                     self.data=ds
                     self.time=ts
-                    if len(ngood) ==1: self.substack = False
+                    if np.count_nonzero(ngood) ==1: self.substack = False
                     else: self.substack=True
                     self.stack_method=method
                 else:
@@ -8,16 +8,18 @@ import sys,time,scipy,obspy,pyasdf
 import datetime,os, glob
 import numpy as np
 import pandas as pd
-from numba import jit
+from numba import jit,prange
 import matplotlib.pyplot  as plt
 from collections import OrderedDict
-from scipy.signal import tukey,hilbert
+from scipy.signal import hilbert
+from scipy.signal.windows import tukey
+from scipy.ndimage import uniform_filter1d
 from obspy.clients.fdsn import Client
 from obspy.core import Stream, Trace, read
 from obspy.core.util.base import _get_function_from_entry_point
 from obspy.signal.util import _npts2nfft
 from obspy.signal.filter import bandpass
-from scipy.fftpack import fft,ifft,fftfreq,next_fast_len
+from scipy.fft import fft,rfft,irfft,fftfreq,next_fast_len
 from obspy.core.inventory import Inventory, Network, Station, Channel, Site
 from obspy.geodetics.base import locations2degrees
 from obspy.taup import TauPyModel
@@ -1084,7 +1086,7 @@ def split_datetimestr(dtstr1,dtstr2,inc_hours):
     return dtlist
 
 #Adapted from NoisePy function with the same name.
-@jit('float32[:](float32[:],float32)')
+@jit('float32[:](float32[:],float32)', cache = True)
 def segment_interpolate(sig1,nfric):
     '''
     this function interpolates the data to ensure all points located on interger times of the
@@ -1298,6 +1300,37 @@ def check_overlap(t1,t2,error=0):
             ind2.append(ind_temp[0])
 
     return ind1,ind2
+@jit(nopython = True, parallel = True, cache = True)
+def _slice_segments(data,nseg,npts,npts_step,rq,win):
+    '''
+    this Numba compiled function cuts nseg windows of npts samples, starting every npts_step
+    samples, from the 1-D data. Each window is demeaned, detrended with the least-squares
+    operator rq (as in detrend()) and multiplied by the taper win, all in one parallel loop.
+
+    RETURNS:
+    ---------------------
+    dataS: 2-D float32 matrix of the processed windows
+    ampmax: maximum absolute amplitude of each processed window
+    '''
+    dataS = np.zeros((nseg,npts),dtype=np.float32)
+    ampmax = np.zeros(nseg,dtype=np.float64)
+    for iseg in prange(nseg):
+        indx1 = iseg*npts_step
+        dmean = 0.
+        for k in range(npts):
+            dmean += data[indx1+k]
+        dmean /= npts
+        coeff0 = 0.
+        coeff1 = 0.
+        for k in range(npts):
+            coeff0 += rq[0,k]*(data[indx1+k]-dmean)
+            coeff1 += rq[1,k]*(data[indx1+k]-dmean)
+        amax = 0.
+        for k in range(npts):
+            dataS[iseg,k] = (data[indx1+k]-dmean-coeff0*k/npts-coeff1)*win[k]
+            if abs(dataS[iseg,k]) > amax: amax = abs(dataS[iseg,k])
+        ampmax[iseg] = amax
+    return dataS,ampmax
 #Modified from noisepy function cut_trace_make_statis().
 def slicing_trace(source,win_len_secs,step_secs=None,taper_frac=0.02):
     '''
@@ -1344,24 +1377,21 @@ def slicing_trace(source,win_len_secs,step_secs=None,taper_frac=0.02):
 
     # initialize variables
     npts = int(win_len_secs*sps)
-    trace_stdS = np.zeros(nseg,dtype=np.float32)
-    dataS    = np.zeros(shape=(nseg,npts),dtype=np.float32)
     dataS_t  = np.zeros(nseg,dtype=np.float32)
 
     print('slicing trace into ['+str(nseg)+'] segments.')
 
-    indx1 = 0
-    for iseg in range(nseg):
-        indx2 = indx1+npts
-        dataS[iseg] = trace_data[indx1:indx2]
-        dataS_t[iseg]    = starttime+step_secs*iseg
-        indx1 += npts_step
+    dataS_t[:] = starttime+step_secs*np.arange(nseg)
 
-    # 2D array processing
-    dataS = detrend(demean(dataS))
-    dataS = taper(dataS,fraction=taper_frac)
-    for iseg in range(nseg):
-        trace_stdS[iseg] = (np.max(np.abs(dataS[iseg]))/all_stdS)
+    # demean, detrend and taper all segments when slicing them. the detrend operator
+    # and the taper window are the same as in detrend() and taper().
+    X = np.ones((npts,2))
+    X[:,0] = np.arange(0,npts)/npts
+    Q,R = np.linalg.qr(X)
+    rq  = np.dot(np.linalg.inv(R),Q.transpose())
+    win = taper(np.ones(npts),fraction=taper_frac)
+    dataS,ampmax = _slice_segments(trace_data,nseg,npts,npts_step,rq,win)
+    trace_stdS = (ampmax/all_stdS).astype(np.float32)
 
     return trace_stdS,dataS_t,dataS
 
@@ -1536,7 +1566,7 @@ def psd(d,s,axis=-1,db=False):
         axis = 0
     elif d.ndim == 2:
         axis = 1
-    Nfft = int(next_fast_len(int(d.shape[axis])))
+    Nfft = int(next_fast_len(int(d.shape[axis]),real=True))
     Nfft2 = int(Nfft//2)
     ft=fft(d,Nfft,axis=axis)
     psd=np.square(np.abs(ft))/s
@@ -1701,16 +1731,11 @@ def smooth2(data, size=[3,3],verbose=False):
         if verbose:print('size has > 3 elements. only the first 3 will be used.')
     if data.ndim < 2 or data.ndim >2:
         raise ValueError('smooth2 works only for 2-d array.')
-    a1,a2=data.shape
     if np.any(data):
-        filt = np.zeros(data.shape)
-        for i in range(a1):
-            filt[i,: ] = np.convolve(
-                data[i,:], np.ones((size[1],))/size[1], mode='same')
-
-        for i in range(a2):
-            filt[:,i] = np.convolve(
-                filt[:,i], np.ones((size[0],))/size[0], mode='same')
+        #running means with zero padding, same as np.convolve(...,mode='same') with a
+        #boxcar along each row and then each column.
+        filt = uniform_filter1d(np.asarray(data,dtype=np.float64),size[1],axis=1,mode='constant')
+        filt = uniform_filter1d(filt,size[0],axis=0,mode='constant')
 
         return filt
     else:
@@ -1899,7 +1924,7 @@ def box_smooth(d, box,mode='same'):
 
     return d_smooth
 #modified from NoisePy function
-@jit(nopython = True)
+@jit(nopython = True, cache = True)
 def moving_ave(A,N):
     '''
     this Numba compiled function does running smooth average for an array.
@@ -1928,6 +1953,24 @@ def moving_ave(A,N):
             B[pos]=1
     return B[N:-N]
 
+def moving_ave2d(A,N):
+    '''
+    this function does running smooth average along the rows of a 2-D array, all rows at once.
+    it gives the same result as calling moving_ave() on each row.
+    PARAMETERS:
+    ---------------------
+    A: 2-D array of data to be smoothed along axis 1
+    N: integer, it defines the half window length to smooth
+
+    RETURNS:
+    ---------------------
+    B: 2-D array with smoothed data
+    '''
+    A = np.concatenate((A[:,:N],A,A[:,-N:]),axis=1)
+    B = uniform_filter1d(A,2*N+1,axis=1)[:,N:-N]
+    B[B==0]=1
+    return B
+
 def ftn(data,dt,fl,fh,df=None,taper_frac=None,taper_maxlen=20,max_abs=2,
             inc_type='linear',nf=100):
     """
@@ -2024,9 +2067,9 @@ def whiten(data,dt,fmin,fmax,method='phase_only',smooth=20,pad=100):
         axis = 0
     elif data.ndim == 2:
         axis = 1
-    Nfft = int(next_fast_len(int(data.shape[axis])))
+    Nfft = int(next_fast_len(int(data.shape[axis]),real=True))
     Nfft2 = int(Nfft//2)
-    FFTRawSign = fft(data, Nfft, axis=axis) # return FFT
+    FFTRawSign = rfft(data, Nfft, axis=axis, workers=-1) # return FFT of the non-negative frequencies
     freqVec = fftfreq(Nfft, d=dt)[:Nfft2]
     J = np.where((freqVec >= fmin) & (freqVec <= fmax))[0]
     low = J[0] - pad
@@ -2049,19 +2092,15 @@ def whiten(data,dt,fmin,fmax,method='phase_only',smooth=20,pad=100):
         if method == 'phase_only':
             FFTRawSign[:,left:right] = np.exp(1j * np.angle(FFTRawSign[:,left:right]))
         elif method == 'rma':
-            for ii in range(self.data.shape[0]):
-                tave = moving_ave(np.abs(FFTRawSign[ii,left:right]),smooth)
-                FFTRawSign[ii,left:right] = FFTRawSign[ii,left:right]/tave
+            FFTRawSign[:,left:right] /= moving_ave2d(np.abs(FFTRawSign[:,left:right]),smooth)
         # Right tapering:
         FFTRawSign[:,right:high] = np.cos(
             np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
             1j * np.angle(FFTRawSign[:,right:high]))
         FFTRawSign[:,high:Nfft2] *= 0
 
-        # Hermitian symmetry (because the input is real)
-        FFTRawSign[:,-Nfft2+1:] = np.flip(np.conj(FFTRawSign[:,1:Nfft2]),axis=axis)
-        ##re-assign back to data.
-        outdata=np.real(ifft(FFTRawSign, Nfft,axis=axis))[:,:data.shape[axis]]
+        ##re-assign back to data. irfft implies the Hermitian symmetry of the real input.
+        outdata=irfft(FFTRawSign, Nfft, axis=axis, workers=-1)[:,:data.shape[axis]]
     else:
         FFTRawSign[0:low] *= 0
         FFTRawSign[low:left] = np.cos(
@@ -2079,11 +2118,8 @@ def whiten(data,dt,fmin,fmax,method='phase_only',smooth=20,pad=100):
             1j * np.angle(FFTRawSign[right:high]))
         FFTRawSign[high:Nfft2] *= 0
 
-        # Hermitian symmetry (because the input is real)
-        FFTRawSign[-Nfft2+1:] = FFTRawSign[1:Nfft2].conjugate()[::-1]
-
-        ##re-assign back to data.
-        outdata=np.real(ifft(FFTRawSign, Nfft,axis=axis))[:data.shape[axis]]
+        ##re-assign back to data. irfft implies the Hermitian symmetry of the real input.
+        outdata=irfft(FFTRawSign, Nfft, axis=axis, workers=-1)[:data.shape[axis]]
     ##
     return outdata
 
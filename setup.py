@@ -1,4 +1,3 @@
-# from numpy.distutils.core import setup
 from setuptools import setup, find_packages
 import pathlib
 
@@ -0,0 +1,41 @@
+import numpy as np
+import obspy
+from obspy import UTCDateTime
+from seisgo import noise
+from seisgo.types import FFTData
+
+def _fftdata(sta,seed,starttime,hours=6,fs=10.,win_len=600,step=300):
+    rng=np.random.default_rng(seed)
+    tr=obspy.Trace(data=rng.standard_normal(int(hours*3600*fs)).astype(np.float32))
+    tr.stats.sampling_rate=fs
+    tr.stats.network='XX'
+    tr.stats.station=sta
+    tr.stats.channel='BHZ'
+    tr.stats.starttime=starttime
+
+    return FFTData(tr,win_len,step,freqmin=0.1,freqmax=2)
+
+def test_correlate_substack_modern_epoch():
+    """
+    Substacks at a modern epoch, where float32 timestamps are spaced ~128 s apart. A window
+    is assigned to a substack with the float32 timestamps and edges, one substack at a time.
+    """
+    f1=_fftdata('A',1,UTCDateTime(2020,1,1))
+    f2=_fftdata('B',2,UTCDateTime(2020,1,1))
+    substack_len=3600
+    # one correlation per window.
+    cwin=noise.correlate(f1,f2,50,substack=True,substack_len=600)
+    csub=noise.correlate(f1,f2,50,substack=True,substack_len=substack_len)
+    twin=np.asarray(cwin.time,dtype=f1.time.dtype)
+    assert len(twin) == len(f1.time)
+
+    tstart=twin[0]
+    nstack=int(np.round((twin[-1]-twin[0])/substack_len))
+    expected=np.zeros((nstack,cwin.data.shape[1]),dtype=np.float64)
+    for i in range(nstack):
+        itime=(twin>=tstart) & (twin<tstart+substack_len)
+        expected[i]=np.mean(cwin.data[itime],axis=0)
+        tstart+=substack_len
+
+    assert csub.data.shape == expected.shape
+    np.testing.assert_allclose(csub.data,expected,rtol=0,atol=1e-4*np.abs(expected).max())